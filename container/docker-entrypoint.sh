@@ -1,12 +1,13 @@
 #!/bin/bash
 
-SOURCE_CONFIG=/app/config/redshift.json
+SOURCE_CONFIG=${SOURCE_CONFIG:-/app/config/redshift.json}
 TARGET_CONFIG=$SOURCE_CONFIG
 
-STATE_FILE=s3://vibe-singer/vibe-cros-raw-events-processor/state.json
+STATE_FILE=${STATE_FILE:-s3://vibe-singer/vibe-cros-raw-events-processor/state.json}
 
 PREV_STATE=/tmp/prev-state.json
 CURR_STATE=/tmp/state.json
+UNTIL_STATE=/tmp/until-state.json
 
 MODE=$1
 TARGET_CONFIG_ARG=$2
@@ -14,15 +15,27 @@ TEMP_CONFIG_ARG=$3
 
 if [ "$MODE" = "debug" ]; then
   MODE_ARG="--debug"
+elif [ "$MODE" = "verify" ]; then
+  if [ -z "$VERIFY_STATE_FILE" ]; then
+    echo "Please specify the old state file to verify from in VERIFY_STATE_FILE."
+    exit 1
+  fi
+  MODE_ARG="--verify --until-state $UNTIL_STATE"
+  if [ -n "$PENDING_SESSIONS_SNAPSHOT" ]; then
+    MODE_ARG="$MODE_ARG --pending-sessions-snapshot $PENDING_SESSIONS_SNAPSHOT"
+  fi
 elif [ "$MODE" = "production" ]; then
   MODE_ARG=""
 else
-  echo "Please specifiy a valid mode: \"debug\" or \"production\"."
+  echo "Please specifiy a valid mode: \"debug\", \"verify\" or \"production\"."
   exit 1
 fi
 
 if [ -n "$TARGET_CONFIG_ARG" ]; then
   TARGET_CONFIG=$TARGET_CONFIG_ARG
+elif [ "$(tr -d ' \t\r\n' < $SOURCE_CONFIG | head -c 1)" = "[" ]; then
+  echo "$SOURCE_CONFIG is a list of source configs. Please specify a target config."
+  exit 1
 fi
 
 if [ -n "$TEMP_CONFIG_ARG" ]; then
@@ -31,9 +44,21 @@ fi
 
 echo "In $MODE mode."
 
-echo "Restoring previous state from $STATE_FILE..."
+if [ "$MODE" = "verify" ]; then
+  echo "Restoring current state from $STATE_FILE..."
+  if ! (aws s3 cp $STATE_FILE $UNTIL_STATE); then
+    echo "Cannot find current state. There is nothing to verify against."
+    exit 1
+  fi
+  PREV_STATE_FILE=$VERIFY_STATE_FILE
+else
+  UNTIL_STATE=""
+  PREV_STATE_FILE=$STATE_FILE
+fi
+
+echo "Restoring previous state from $PREV_STATE_FILE..."
 
-if (aws s3 cp $STATE_FILE $PREV_STATE); then
+if (aws s3 cp $PREV_STATE_FILE $PREV_STATE); then
   STATE_ARG="-s $PREV_STATE"
   echo "Previous state successfully loaded."
 else
@@ -43,12 +68,18 @@ else
 fi
 
 ./run.py -r $SOURCE_CONFIG -c $TARGET_CONFIG $ADDITIONAL_TEMP_CONFIG_ARG $STATE_ARG $MODE_ARG > $CURR_STATE
+STATUS=$?
 
-if [ "$MODE" = "debug" ]; then
-  echo "Do not save state file in debug mode."
+if [ "$MODE" = "debug" ] || [ "$MODE" = "verify" ]; then
+  echo "Do not save state file in $MODE mode."
+elif [ $STATUS -ne 0 ]; then
+  echo "run.py exited with status $STATUS. Do not save state file."
 else
   echo "Saving state to $STATE_FILE..."
   aws s3 cp $CURR_STATE $STATE_FILE
+  STATUS=$?
 fi
 
-rm $CURR_STATE $PREV_STATE
\ No newline at end of file
+rm $CURR_STATE $PREV_STATE $UNTIL_STATE
+
+exit $STATUS
\ No newline at end of file
@@ -1,5 +1,8 @@
-from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import chain
 from .utils import get_logger
+from .verifier import Verifier
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import json
@@ -26,6 +29,14 @@ class DatabaseOutOfSyncError(Error):
     """Raised when table in database is out of sync"""
     pass
 
+class DuplicateSourceError(Error):
+    """Raised when several raw event sources share the same name"""
+    pass
+
+class AmbiguousLegacyStateError(Error):
+    """Raised when more than one raw event source is marked to continue from a single-source state"""
+    pass
+
 class State():
     """
     Possible values:
@@ -42,18 +53,28 @@ class RawEventProcessor():
     state_bookmark_key = 'max_raw_event_receiving_time'
     raw_event_bookmark_key = 'collector_tstamp'
 
-    def __init__(self, raw_events_config, cros_sessions_config, intermediate_storage_config, last_processor_state, debug, drop):
+    def __init__(self, raw_events_config, cros_sessions_config, intermediate_storage_config, last_processor_state, debug, drop, verify=False, pending_sessions_snapshot=None, until_processor_state=None):
         LOGGER.info("Initiate RawEventProcessor.")
         self.last_processor_state = last_processor_state
         self.current_proccesor_state = {}
-        self.last_max_raw_event_receiving_time = (last_processor_state or {}).get(RawEventProcessor.state_bookmark_key) or raw_events_config['start_date']
-        self.debug = debug
+        self.debug = debug or verify
+        self.verify = verify
+        self.pending_sessions_snapshot = pending_sessions_snapshot
+        self.until_processor_state = until_processor_state
+        self.verification_passed = None
+
+        """
+        raw_events_config is either a single source config, or a list of source configs when several
+        raw event sources are fanned in to the same cros_sessions target. In the latter case each source
+        keeps its own bookmark under state['sources'][<source name>].
+        """
+        self.multi_source = isinstance(raw_events_config, list)
+        self.raw_events_configs = raw_events_config if self.multi_source else [raw_events_config]
 
         self.last_event = None
         self.last_pending_session_event = None
         self.last_pending_session_info = None
 
-        self.raw_events_cur = self.connect_postgres(raw_events_config)
         self.cros_sessions_cur = self.connect_postgres(cros_sessions_config)
         self.intermediate_storage_cur = self.cros_sessions_cur if intermediate_storage_config is None else self.connect_postgres(intermediate_storage_config)
 
@@ -64,28 +85,6 @@ class RawEventProcessor():
         self.pending_sessions_sql_tasks = {}
         self.temp_stored_start_or_end = []
 
-        select_new_raw_events_sql = f"""
-        SELECT
-            ctx.serial,
-            ctx.user_id,
-            ae.action,
-            e.derived_tstamp AS tstamp,
-            ctx.session_id,
-            ctx.session_type,
-            e.collector_tstamp
-        FROM
-            atomic.us_vibe_cros_action_event_1 ae
-            JOIN atomic.us_vibe_cros_event_context_1 ctx ON ae.root_id = ctx.root_id
-            JOIN atomic.events e ON e.event_id = ctx.root_id
-        WHERE
-            e.{RawEventProcessor.raw_event_bookmark_key} > '{self.last_max_raw_event_receiving_time}' -- Use collector_tstamp here
-            AND ctx.serial NOT LIKE '%OEM%' AND ctx.serial <> '123456789'
-        ORDER BY ctx.serial, e.derived_tstamp, ae.action
-        """
-        self.raw_events_cur.execute(select_new_raw_events_sql)
-        self.raw_events_rows = self.raw_events_cur.fetchall()
-        LOGGER.info(f"{len(self.raw_events_rows)} raw events found.")
-
         self.intermediate_storage_cur.execute("CREATE SCHEMA IF NOT EXISTS cros_derived")
         create_pending_sessions_table_sql = """
         CREATE TABLE IF NOT EXISTS cros_derived.pending_sessions (
@@ -114,7 +113,113 @@ class RawEventProcessor():
         """
         self.cros_sessions_cur.execute(create_cros_sessions_table_sql)
 
-        select_pending_sessions_sql = """
+        """Carry every bookmark forward so a source without new events does not fall back to start_date."""
+        if self.multi_source:
+            if len([config for config in self.raw_events_configs if config.get('migrate_from_legacy_state')]) > 1:
+                raise AmbiguousLegacyStateError
+            sources_state = {}
+            for config in self.raw_events_configs:
+                source_name = self.get_source_name(config)
+                if source_name in sources_state:
+                    raise DuplicateSourceError
+                sources_state[source_name] = {
+                    RawEventProcessor.state_bookmark_key: str(self.get_last_max_raw_event_receiving_time(config))
+                }
+            self.update_processor_state({ 'sources': sources_state })
+        else:
+            self.update_processor_state({
+                RawEventProcessor.state_bookmark_key: str(self.get_last_max_raw_event_receiving_time(self.raw_events_configs[0]))
+            })
+
+        """
+        Every source gets its own connection, and all of them are queried on a shared worker pool
+        together with the pending sessions load, so startup costs about as much as the slowest source.
+        """
+        with ThreadPoolExecutor(max_workers=len(self.raw_events_configs) + 1) as pool:
+            pending_sessions_future = pool.submit(self.select_pending_sessions)
+            raw_events_futures = [pool.submit(self.select_new_raw_events, config) for config in self.raw_events_configs]
+            self.pending_sessions_rows = pending_sessions_future.result()
+            raw_events_rows_by_source = [future.result() for future in raw_events_futures]
+
+        if len(raw_events_rows_by_source) == 1:
+            self.raw_events_rows = raw_events_rows_by_source[0]
+        else:
+            """
+            Events of a serial seen by several sources end up interleaved in time order, which is what
+            the shared pending_sessions map expects. NULL tstamps sort last, as in Redshift.
+            """
+            self.raw_events_rows = sorted(chain(*raw_events_rows_by_source), key=lambda row: (row['serial'], row['tstamp'] is None, row['tstamp'] or datetime.min, row['action']))
+        LOGGER.info(f"{len(self.raw_events_rows)} raw events found.")
+
+        for pending_session in self.pending_sessions_rows:
+            serial = pending_session['serial']
+            if self.pending_sessions.get(serial) is not None:
+                raise UnmatchedPendingSessionError
+            self.pending_sessions[serial] = dict(pending_session)
+
+    def get_source_name(self, raw_events_config):
+        return raw_events_config.get('name') or f"{raw_events_config['host']}/{raw_events_config['database']}/{raw_events_config.get('schema', 'atomic')}"
+
+    def get_bookmark(self, processor_state, raw_events_config):
+        """
+        Returns the bookmark of the given source in processor_state, or None if it has none.
+
+        When a deployment switches from a single source config to a list of them, the state has no
+        'sources' map yet. The one source marked with migrate_from_legacy_state then continues from the
+        top-level bookmark; every other source starts from its own start_date.
+        """
+        processor_state = processor_state or {}
+        if not self.multi_source:
+            return processor_state.get(RawEventProcessor.state_bookmark_key)
+        if 'sources' in processor_state:
+            return processor_state['sources'].get(self.get_source_name(raw_events_config), {}).get(RawEventProcessor.state_bookmark_key)
+        if raw_events_config.get('migrate_from_legacy_state'):
+            return processor_state.get(RawEventProcessor.state_bookmark_key)
+        return None
+
+    def get_last_max_raw_event_receiving_time(self, raw_events_config):
+        return self.get_bookmark(self.last_processor_state, raw_events_config) or raw_events_config['start_date']
+
+    def select_new_raw_events(self, raw_events_config):
+        source_name = self.get_source_name(raw_events_config)
+        schema = raw_events_config.get('schema', 'atomic')
+        last_max_raw_event_receiving_time = self.get_last_max_raw_event_receiving_time(raw_events_config)
+        until_condition = ''
+        if self.until_processor_state is not None:
+            """A source the until state has no bookmark for has not been processed, so nothing is selected."""
+            until = self.get_bookmark(self.until_processor_state, raw_events_config) or last_max_raw_event_receiving_time
+            until_condition = f"AND e.{RawEventProcessor.raw_event_bookmark_key} <= '{until}'"
+
+        raw_events_cur = self.connect_postgres(raw_events_config)
+        select_new_raw_events_sql = f"""
+        SELECT
+            ctx.serial,
+            ctx.user_id,
+            ae.action,
+            e.derived_tstamp AS tstamp,
+            ctx.session_id,
+            ctx.session_type,
+            e.collector_tstamp
+        FROM
+            {schema}.us_vibe_cros_action_event_1 ae
+            JOIN {schema}.us_vibe_cros_event_context_1 ctx ON ae.root_id = ctx.root_id
+            JOIN {schema}.events e ON e.event_id = ctx.root_id
+        WHERE
+            e.{RawEventProcessor.raw_event_bookmark_key} > '{last_max_raw_event_receiving_time}' -- Use collector_tstamp here
+            {until_condition}
+            AND ctx.serial NOT LIKE '%OEM%' AND ctx.serial <> '123456789'
+        ORDER BY ctx.serial, e.derived_tstamp, ae.action
+        """
+        try:
+            raw_events_cur.execute(select_new_raw_events_sql)
+            rows = [dict(row, source=source_name) for row in raw_events_cur.fetchall()]
+        finally:
+            raw_events_cur.connection.close()
+        LOGGER.info(f"{len(rows)} raw events found in source {source_name}.")
+        return rows
+
+    def select_pending_sessions(self):
+        select_pending_sessions_sql = f"""
         SELECT
             serial,
             user_id,
@@ -125,16 +230,10 @@ class RawEventProcessor():
             last_state,
             split_counter
         FROM
-            cros_derived.pending_sessions
+            {self.pending_sessions_snapshot or 'cros_derived.pending_sessions'}
         """
         self.intermediate_storage_cur.execute(select_pending_sessions_sql)
-        self.pending_sessions_rows = self.intermediate_storage_cur.fetchall()
-
-        for pending_session in self.pending_sessions_rows:
-            serial = pending_session['serial']
-            if self.pending_sessions.get(serial) is not None:
-                raise UnmatchedPendingSessionError
-            self.pending_sessions[serial] = dict(pending_session)
+        return self.intermediate_storage_cur.fetchall()
 
     def connect_postgres(self, config):
         if config is None:
@@ -319,8 +418,11 @@ class RawEventProcessor():
                 LOGGER.info("No pending session with same serial. Thus initiate a new one.")
                 self.initiate_pending_session(current_event)
             LOGGER.info(f"Finish processing the first event in this batch for raw session with serial={current_event['serial']} and id={current_event['session_id']}.")
-        new_state_bookmark_value = max(self.current_proccesor_state.get(RawEventProcessor.state_bookmark_key, ''), str(current_event[RawEventProcessor.raw_event_bookmark_key]))
-        self.update_processor_state({ RawEventProcessor.state_bookmark_key: new_state_bookmark_value })
+        self.update_bookmark(current_event)
+
+    def update_bookmark(self, current_event):
+        source_state = self.current_proccesor_state['sources'][current_event['source']] if self.multi_source else self.current_proccesor_state
+        source_state[RawEventProcessor.state_bookmark_key] = max(source_state[RawEventProcessor.state_bookmark_key], str(current_event[RawEventProcessor.raw_event_bookmark_key]))
 
     def process_raw_events(self):
         LOGGER.info("Start to process raw events.")
@@ -332,7 +434,8 @@ class RawEventProcessor():
             self.process_current_event(current_event)
             self.last_event = current_event
 
-        self.process_last_session(self.last_event)
+        if self.last_event is not None:
+            self.process_last_session(self.last_event)
         self.finish()
 
     def print_cros_sessions(self):
@@ -386,6 +489,9 @@ class RawEventProcessor():
         First update session in cros_derived.pending_sessions, and then store the following fields from
         session into cros sessions table.
         """
+        if not sessions:
+            return
+
         cros_sessions_columns = 'serial, user_id, session_id, tstamp, session_type, action'
         session_value_string = str(sessions)[1:-1]
 
@@ -518,6 +624,8 @@ class RawEventProcessor():
         pending_session_value_string = pending_session_value_string[:-1]
 
         LOGGER.info(pending_session_value_string)
+        if not pending_sessions_copy:
+            return
 
         sql = f'''
                INSERT INTO cros_derived.pending_sessions ({pending_sessions_columns})
@@ -538,12 +646,37 @@ class RawEventProcessor():
     def update_processor_state(self, updates):
         self.current_proccesor_state.update(updates)
 
+    def get_verify_window(self, serials):
+        """
+        The tstamp range any cros session of this run can fall into: from the earliest raw event, moved
+        back by IDLE_TIME for Idle SessionEnds, or the last event time of a pending session of these
+        serials that is ended by this run, to the latest raw event.
+        """
+        tstamps = [row['tstamp'] for row in self.raw_events_rows if row['tstamp'] is not None]
+        if not tstamps:
+            return None, None
+        window_start = min(tstamps) - IDLE_TIME
+        window_end = max(tstamps)
+        for pending_session in self.pending_sessions_rows:
+            if pending_session['serial'] in serials:
+                window_start = min(window_start, pending_session['last_event_time'])
+        return window_start, window_end
+
     def finish(self):
         """
         1. Do insert/update in database
         2. Commit database changes.
         3. Write new state.
+
+        In verify mode nothing is written. Instead the results are compared against what is already
+        stored in cros_derived, see Verifier.
         """
+        if self.verify:
+            verifier = Verifier(self.cros_sessions_cur, self.intermediate_storage_cur)
+            serials = {row['serial'] for row in self.raw_events_rows}
+            window_start, window_end = self.get_verify_window(serials)
+            self.verification_passed = verifier.verify(self.temp_stored_start_or_end, self.pending_sessions, serials, window_start, window_end, self.pending_sessions_snapshot is not None)
+            LOGGER.info(f"Verification {'passed' if self.verification_passed else 'failed'}.")
         if not self.debug:
             self.insert_cros_sessions_into_database(self.temp_stored_start_or_end)
             self.update_pending_sessions_in_database()
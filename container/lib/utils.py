@@ -49,7 +49,7 @@ def parse_args():
     Parses the command-line arguments mentioned in the SPEC and the
     BEST_PRACTICES documents:
 
-    -r,--raw            Raw event source config
+    -r,--raw            Raw event source config, or a list of them
     -c,--cros           Cros sessions target config
     -i,--intermediate   Intermediate storage target config
 
@@ -61,7 +61,7 @@ def parse_args():
 
     parser.add_argument(
         '-r', '--raw',
-        help='Raw events source config.',
+        help='Raw events source config. May also be a list of source configs, which are processed together into the same targets.',
         required=True)
 
     parser.add_argument(
@@ -82,19 +82,51 @@ def parse_args():
         action="store_true",
         help='Debug mode.')
 
+    parser.add_argument(
+        '--verify',
+        action="store_true",
+        help='Verification mode. Like debug mode, but also compares the results against the existing tables by hash. '
+             'Replays the raw events between an old state file (-s) and the current production state file (--until-state), '
+             'i.e. exactly the events production has processed since the old state. '
+             'cros_sessions rows are compared for the serials seen in this run, from the earliest input tstamp '
+             '(minus the idle time, or the last event time of a pending session of those serials) to the latest one. '
+             'Pending sessions are compared only with --pending-sessions-snapshot; without it, serials with a pending '
+             'session at the old state may report false differences.')
+
+    parser.add_argument(
+        '--until-state',
+        help='State file whose bookmarks are the inclusive upper bound of the raw events to process, '
+             'usually the current production state. Required with --verify, and only valid with it.')
+
+    parser.add_argument(
+        '--pending-sessions-snapshot',
+        help='Table in intermediate storage holding a copy of cros_derived.pending_sessions taken together with the old state file. '
+             'The verify run starts from it and compares the resulting pending sessions against cros_derived.pending_sessions, '
+             'which matches the state given by --until-state. Only valid with --verify.')
+
     parser.add_argument(
         '--drop',
         action="store_true",
         help='Drop tables.')
 
     args = parser.parse_args()
+    if args.pending_sessions_snapshot and not args.verify:
+        parser.error('--pending-sessions-snapshot is only valid with --verify.')
+    if bool(args.until_state) != args.verify:
+        parser.error('--until-state is required with --verify, and only valid with it.')
     if args.raw:
         args.raw = load_json(args.raw)
     if args.cros:
         args.cros = load_json(args.cros)
+        if not isinstance(args.cros, dict):
+            parser.error('--cros must be a single target config. Only --raw accepts a list of configs.')
     if args.intermediate:
         args.intermediate = load_json(args.intermediate)
+        if not isinstance(args.intermediate, dict):
+            parser.error('--intermediate must be a single target config. Only --raw accepts a list of configs.')
     if args.state:
         args.state = load_json(args.state)
+    if args.until_state:
+        args.until_state = load_json(args.until_state)
 
     return args
\ No newline at end of file
@@ -0,0 +1,174 @@
+from collections import Counter
+from datetime import datetime
+from .utils import get_logger
+import hashlib
+
+LOGGER = get_logger()
+
+VERIFY_BUCKETS = 1024
+VERIFY_MAX_DRILL_DOWN_BUCKETS = 64
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+SQL_TIMESTAMP_FORMAT = 'YYYY-MM-DD HH24:MI:SS.US'
+SEPARATOR = '|'
+
+CROS_SESSIONS_COLUMNS = ['serial', 'user_id', 'session_id', 'tstamp', 'session_type', 'action']
+PENDING_SESSIONS_COLUMNS = ['serial', 'user_id', 'raw_session_id', 'start_time', 'last_event_time', 'session_type', 'last_state', 'split_counter']
+TIMESTAMP_COLUMNS = ['tstamp', 'start_time', 'last_event_time']
+
+def format_value(column, value):
+    if column in TIMESTAMP_COLUMNS:
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        return value.strftime(TIMESTAMP_FORMAT)
+    return str(value)
+
+def build_row_string(columns, row):
+    return SEPARATOR.join(format_value(column, row[column]) for column in columns)
+
+def build_row_string_sql(columns):
+    """SQL counterpart of build_row_string, producing byte-identical strings on Redshift."""
+    parts = []
+    for column in columns:
+        if column in TIMESTAMP_COLUMNS:
+            parts.append(f"TO_CHAR({column}, '{SQL_TIMESTAMP_FORMAT}')")
+        else:
+            parts.append(f"CAST({column} AS VARCHAR)")
+    return f" || '{SEPARATOR}' || ".join(parts)
+
+def build_in_list(values):
+    return ', '.join("'" + value.replace("'", "''") + "'" for value in sorted(values))
+
+def md5_hex(value):
+    return hashlib.md5(value.encode('utf-8')).hexdigest()
+
+def row_hash(row_string):
+    """First 60 bits of the md5, so that it fits into Redshift's STRTOL."""
+    return int(md5_hex(row_string)[:15], 16)
+
+def serial_bucket(serial):
+    return int(md5_hex(serial)[:8], 16) % VERIFY_BUCKETS
+
+ROW_HASH_SQL = "STRTOL(SUBSTRING(MD5(row_string), 1, 15), 16)::DECIMAL(38, 0)"
+SERIAL_BUCKET_SQL = f"STRTOL(SUBSTRING(MD5(serial), 1, 8), 16) % {VERIFY_BUCKETS}"
+
+class Verifier():
+    """
+    Compares the rows a run would have written against what is already stored in cros_derived.
+
+    Rows are split into buckets by serial. For each bucket an order-independent digest (row count and
+    sum of row hashes) is computed locally and, with a single aggregate query, on the server. Only the
+    buckets whose digests differ are fetched row by row to report the actual differences.
+    """
+
+    def __init__(self, cros_sessions_cur, intermediate_storage_cur):
+        self.cros_sessions_cur = cros_sessions_cur
+        self.intermediate_storage_cur = intermediate_storage_cur
+
+    def verify(self, cros_sessions, pending_sessions, serials, window_start, window_end, compare_pending_sessions):
+        """
+        cros_sessions is the list of emitted (serial, user_id, session_id, tstamp, session_type, action)
+        tuples, pending_sessions the resulting serial-keyed pending session dict and serials the serials
+        that had raw events in this run.
+
+        cros_sessions rows are compared for the serials in this run only, between window_start and
+        window_end, which are derived from the input of the run rather than its output. Either bound may
+        be None if the input has no tstamps, in which case all rows of those serials are compared.
+
+        pending_sessions are compared as a whole, and only if compare_pending_sessions is set, i.e. the
+        run started from a pending sessions snapshot matching its bookmark.
+        Returns True if everything compared matches the database.
+        """
+        cros_sessions_rows = [dict(zip(CROS_SESSIONS_COLUMNS, session)) for session in cros_sessions]
+        if serials:
+            where = f"serial IN ({build_in_list(serials)})"
+            if window_start is not None and window_end is not None:
+                where += f" AND tstamp BETWEEN '{format_value('tstamp', window_start)}' AND '{format_value('tstamp', window_end)}'"
+            LOGGER.info(f"Verify cros sessions of {len(serials)} serials between {window_start} and {window_end}.")
+            cros_sessions_match = self.verify_table(
+                self.cros_sessions_cur,
+                'cros_derived.cros_sessions',
+                CROS_SESSIONS_COLUMNS,
+                cros_sessions_rows,
+                where
+            )
+        else:
+            LOGGER.info("No raw events in this run. Skip verifying cros sessions.")
+            cros_sessions_match = True
+
+        if compare_pending_sessions:
+            LOGGER.info("Verify pending sessions.")
+            pending_sessions_match = self.verify_table(
+                self.intermediate_storage_cur,
+                'cros_derived.pending_sessions',
+                PENDING_SESSIONS_COLUMNS,
+                list(pending_sessions.values()),
+                'TRUE'
+            )
+        else:
+            LOGGER.info("No pending sessions snapshot given. Skip verifying pending sessions.")
+            pending_sessions_match = True
+        return cros_sessions_match and pending_sessions_match
+
+    def verify_table(self, cur, table, columns, rows, where):
+        local_rows_by_bucket = {}
+        local_digests = {}
+        for row in rows:
+            bucket = serial_bucket(row['serial'])
+            row_string = build_row_string(columns, row)
+            local_rows_by_bucket.setdefault(bucket, []).append(row_string)
+            count, hash_sum = local_digests.get(bucket, (0, 0))
+            local_digests[bucket] = (count + 1, hash_sum + row_hash(row_string))
+
+        remote_digests = self.select_digests(cur, table, columns, where)
+
+        mismatched_buckets = sorted(bucket for bucket in set(local_digests) | set(remote_digests) if local_digests.get(bucket) != remote_digests.get(bucket))
+        LOGGER.info(f"{table}: {len(rows)} rows in this run, {sum(count for count, _ in remote_digests.values())} rows in database, {len(mismatched_buckets)} of {VERIFY_BUCKETS} buckets differ.")
+        if not mismatched_buckets:
+            return True
+
+        """Drill down into at most VERIFY_MAX_DRILL_DOWN_BUCKETS buckets, all fetched with a single query."""
+        drill_down_buckets = mismatched_buckets[:VERIFY_MAX_DRILL_DOWN_BUCKETS]
+        if len(drill_down_buckets) < len(mismatched_buckets):
+            LOGGER.warning(f"{table}: only report rows of the first {len(drill_down_buckets)} differing buckets.")
+        remote_rows_by_bucket = self.select_bucket_rows(cur, table, columns, where, drill_down_buckets)
+        for bucket in drill_down_buckets:
+            local_rows = Counter(local_rows_by_bucket.get(bucket, []))
+            remote_rows = Counter(remote_rows_by_bucket.get(bucket, []))
+            for row_string in sorted((local_rows - remote_rows).elements()):
+                LOGGER.warning(f"{table} bucket {bucket}: only in this run: {row_string}")
+            for row_string in sorted((remote_rows - local_rows).elements()):
+                LOGGER.warning(f"{table} bucket {bucket}: only in database: {row_string}")
+
+        return False
+
+    def select_digests(self, cur, table, columns, where):
+        sql = f"""
+        SELECT
+            bucket,
+            COUNT(*) AS row_count,
+            SUM({ROW_HASH_SQL}) AS hash_sum
+        FROM (
+            SELECT
+                {SERIAL_BUCKET_SQL} AS bucket,
+                {build_row_string_sql(columns)} AS row_string
+            FROM {table}
+            WHERE {where}
+        ) AS verified_rows
+        GROUP BY bucket
+        """
+        cur.execute(sql)
+        return {row['bucket']: (row['row_count'], int(row['hash_sum'])) for row in cur.fetchall()}
+
+    def select_bucket_rows(self, cur, table, columns, where, buckets):
+        sql = f"""
+        SELECT
+            {SERIAL_BUCKET_SQL} AS bucket,
+            {build_row_string_sql(columns)} AS row_string
+        FROM {table}
+        WHERE {where} AND {SERIAL_BUCKET_SQL} IN ({', '.join(str(bucket) for bucket in buckets)})
+        """
+        cur.execute(sql)
+        rows_by_bucket = {}
+        for row in cur.fetchall():
+            rows_by_bucket.setdefault(row['bucket'], []).append(row['row_string'])
+        return rows_by_bucket
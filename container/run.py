@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
+import sys
 from lib.raw_event_processor import RawEventProcessor
 from lib import utils
 
 def main():
     args = utils.parse_args()
-    raw_events_config = utils.expand_env(args.raw)
+    if isinstance(args.raw, list):
+        raw_events_config = [utils.expand_env(config) for config in args.raw]
+    else:
+        raw_events_config = utils.expand_env(args.raw)
     intermediate_storage_config = utils.expand_env(args.intermediate)
     cros_sessions_config = utils.expand_env(args.cros)
 
@@ -14,12 +18,17 @@ def main():
         intermediate_storage_config=intermediate_storage_config,
         last_processor_state=args.state,
         debug=args.debug,
-        drop=args.drop
+        drop=args.drop,
+        verify=args.verify,
+        pending_sessions_snapshot=args.pending_sessions_snapshot,
+        until_processor_state=args.until_state
     )
     if args.drop:
         processor.drop_tables()
     else:
         processor.process_raw_events()
+        if processor.verification_passed is False:
+            sys.exit(1)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file